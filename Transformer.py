@@ -5,17 +5,23 @@
 import os
 import logging
 import numpy as np
-import tensorflow as tf
 import math, copy, time
+import contextlib
 from tqdm import tqdm
 
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torchtext import data
-from torch.utils.data import TensorDataset, DataLoader
-from torch.autograd import Variable
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data import TensorDataset
+
+try:
+    from apex.normalization import FusedLayerNorm as _LayerNorm
+except ImportError:
+    _LayerNorm = nn.LayerNorm
 
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -41,6 +47,10 @@ class EncoderDecoder(nn.Module):
     def decode(self, memory, src_mask, tgt, tgt_mask):
         return self.decoder(self.tgt_embed(tgt), memory, src_mask, tgt_mask)
 
+    def step_decode(self, memory, src_mask, new_tok, cache, pos):
+        #Decode only the newest target token at position `pos`, reusing the cached K,V.
+        return self.decoder.step_decode(self.tgt_embed(new_tok, offset = pos), memory, src_mask, cache)
+
     
 class Generator(nn.Module):
     #Define standard linear + softmax generation step.
@@ -49,11 +59,14 @@ class Generator(nn.Module):
         self.proj = nn.Linear(d_model, vocab)
 
     def forward(self, x):
-        return F.log_softmax(self.proj(x), dim =-1)
+        return F.log_softmax(self.logits(x), dim =-1)
 
-def clones(module, N):
-    #Produce N identical layers.
-    return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
+    def logits(self, x):
+        return self.proj(x)
+
+def clones(factory, N):
+    #Produce N freshly constructed layers.
+    return nn.ModuleList([factory() for _ in range(N)])
 
 
 class Encoder(nn.Module):
@@ -61,7 +74,7 @@ class Encoder(nn.Module):
     def __init__(self, layer, N):
         super(Encoder, self).__init__()
         self.layers = clones(layer, N)
-        self.norm = LayerNorm(layer.size)
+        self.norm = LayerNorm(self.layers[0].size)
         
     def forward(self, x, mask):
         #Pass the input (and mask) through each layer in turn.
@@ -71,17 +84,13 @@ class Encoder(nn.Module):
 
 
 class LayerNorm(nn.Module):
-    #Construct a layernorm module (See citation for details).
+    #Construct a layernorm module backed by the fused kernel (Apex if installed).
     def __init__(self, features, eps = 1e-6):
         super(LayerNorm, self).__init__()
-        self.a_2 = nn.Parameter(torch.ones(features))
-        self.b_2 = nn.Parameter(torch.zeros(features))
-        self.eps = eps
+        self.ln = _LayerNorm(features, eps = eps)
 
     def forward(self, x):
-        mean = x.mean(-1, keepdim =True)
-        std = x.std(-1, keepdim =True)
-        return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
+        return self.ln(x)
 
 
 class SublayerConnection(nn.Module):
@@ -102,7 +111,7 @@ class EncoderLayer(nn.Module):
         super(EncoderLayer, self).__init__()
         self.self_attn = self_attn
         self.feed_forward = feed_forward
-        self.sublayer = clones(SublayerConnection(size, dropout), 2)
+        self.sublayer = clones(lambda: SublayerConnection(size, dropout), 2)
         self.size = size
 
     def forward(self, x, mask):
@@ -115,13 +124,22 @@ class Decoder(nn.Module):
     def __init__(self, layer, N):
         super(Decoder, self).__init__()
         self.layers = clones(layer, N)
-        self.norm = LayerNorm(layer.size)
+        self.norm = LayerNorm(self.layers[0].size)
         
     def forward(self, x, memory, src_mask, tgt_mask):
         for layer in self.layers:
             x = layer(x, memory, src_mask, tgt_mask)
         return self.norm(x)
 
+    def init_cache(self):
+        "One K,V cache per layer; the src-attn entry holds the projected memory."
+        return [{'self': {}, 'src': {'static': True}} for _ in self.layers]
+
+    def step_decode(self, x, memory, src_mask, cache):
+        for layer, layer_cache in zip(self.layers, cache):
+            x = layer.step_decode(x, memory, src_mask, layer_cache)
+        return self.norm(x)
+
 
 class DecoderLayer(nn.Module):
     "Decoder is made of self-attn, src-attn, and feed forward (defined below)"
@@ -131,7 +149,7 @@ class DecoderLayer(nn.Module):
         self.self_attn = self_attn
         self.src_attn = src_attn
         self.feed_forward = feed_forward
-        self.sublayer = clones(SublayerConnection(size, dropout), 3)
+        self.sublayer = clones(lambda: SublayerConnection(size, dropout), 3)
  
     def forward(self, x, memory, src_mask, tgt_mask):
         "Follow Figure 1 (right) for connections."
@@ -140,18 +158,50 @@ class DecoderLayer(nn.Module):
         x = self.sublayer[1](x, lambda x: self.src_attn(x, m, m, src_mask))
         return self.sublayer[2](x, self.feed_forward)
 
-def subsequent_mask(size):
-    "Mask out subsequent positions."
-    attn_shape = (1, size, size)
-    subsequent_mask = np.triu(np.ones(attn_shape), k = 1).astype('uint8')
-    return torch.from_numpy(subsequent_mask) == 0
+    def step_decode(self, x, memory, src_mask, cache):
+        "Same as forward for a single new token; causality is enforced by the cache."
+        m = memory
+        x = self.sublayer[0](x, lambda x: self.self_attn(x, x, x, cache = cache['self']))
+        x = self.sublayer[1](x, lambda x: self.src_attn(x, m, m, src_mask, cache = cache['src']))
+        return self.sublayer[2](x, self.feed_forward)
+
+def autocast():
+    "bf16 autocast on GPUs with bf16 tensor cores (no GradScaler needed); a no-op elsewhere."
+    if device.type == 'cuda' and hasattr(torch, 'autocast') and torch.cuda.is_bf16_supported():
+        return torch.autocast(device_type = 'cuda', dtype = torch.bfloat16)
+    return contextlib.nullcontext()
+
+def inference_mode():
+    return torch.inference_mode() if hasattr(torch, 'inference_mode') else torch.no_grad()
+
+_causal_masks = {}
+
+def subsequent_mask(size, device = device):
+    "Mask out subsequent positions; built once per device and sliced afterwards."
+    mask = _causal_masks.get(device)
+    if mask is None or mask.size(-1) < size:
+        mask = torch.ones(1, size, size, dtype = torch.bool, device = device).tril_()
+        _causal_masks[device] = mask
+    return mask[:, :size, :size]
+
+def additive_mask(keep):
+    "Turn a boolean keep-mask into a float mask that is 0 where kept and -inf where masked."
+    return torch.zeros(keep.shape, device = keep.device).masked_fill_(~keep, float('-inf'))
 
 def attention(query, key, value, mask =None, dropout =None):
-    "Compute 'Scaled Dot Product Attention'"
+    "Compute 'Scaled Dot Product Attention'. `mask` is a boolean keep-mask or an additive float mask."
+    if mask is not None and mask.dtype != torch.bool:
+        mask = mask.to(query.dtype)
+    if hasattr(F, 'scaled_dot_product_attention'):
+        # Fused (Flash/memory-efficient) kernel, never materializes p_attn.
+        dropout_p = dropout.p if dropout is not None and dropout.training else 0.0
+        return F.scaled_dot_product_attention(query, key, value, attn_mask = mask, dropout_p = dropout_p), None
     d_k = query.size(-1)
     scores = torch.matmul(query, key.transpose(-2, -1)) / math.sqrt(d_k)
-    if mask is not None:
+    if mask is not None and mask.dtype == torch.bool:
         scores = scores.masked_fill(mask == 0, -1e9)
+    elif mask is not None:
+        scores = scores + mask
     p_attn = F.softmax(scores, dim = -1)
     if dropout is not None:
         p_attn = dropout(p_attn)
@@ -166,26 +216,58 @@ class MultiHeadedAttention(nn.Module):
         # We assume d_v always equals d_k
         self.d_k = d_model // h
         self.h = h
-        self.linears = clones(nn.Linear(d_model, d_model), 4)
+        # Q, K and V projections are stored as one fused weight.
+        self.qkv = nn.Linear(d_model, 3 * d_model)
+        self.out = nn.Linear(d_model, d_model)
+        # Attention weights of the last call, kept for visualization. None on the fused SDPA path.
         self.attn = None
         self.dropout = nn.Dropout(p = dropout)
+
+    def project(self, x, start, n):
+        "Apply `n` consecutive slices of the fused projection, starting at `start` (0=Q, 1=K, 2=V)."
+        d_model = self.h * self.d_k
+        rows = slice(start * d_model, (start + n) * d_model)
+        return F.linear(x, self.qkv.weight[rows], self.qkv.bias[rows])
+
+    def split_heads(self, x, n):
+        "[B, T, n*d_model] -> n contiguous [B, h, T, d_k] tensors, using one permute copy for all n."
+        x = x.view(x.size(0), -1, n, self.h, self.d_k).permute(2, 0, 3, 1, 4).contiguous()
+        return x.unbind(0)
         
-    def forward(self, query, key, value, mask =None):
+    def forward(self, query, key, value, mask =None, cache =None):
         if mask is not None:
             # Same mask applied to all h heads.
             mask = mask.unsqueeze(1)
         nbatches = query.size(0)
         
         # 1) Do all the linear projections in batch from d_model => h x d_k 
-        query, key, value = [l(x).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
-             for l, x in zip(self.linears, (query, key, value))]
+        if cache is not None and cache.get('static') and 'k' in cache:
+            # Memory was already projected on the first decoding step.
+            query, = self.split_heads(self.project(query, 0, 1), 1)
+            key, value = cache['k'], cache['v']
+        else:
+            if query is key and key is value:
+                # Self-attention: one GEMM for all three projections.
+                query, key, value = self.split_heads(self.qkv(query), 3)
+            elif key is value:
+                query, = self.split_heads(self.project(query, 0, 1), 1)
+                key, value = self.split_heads(self.project(key, 1, 2), 2)
+            else:
+                (query,), (key,), (value,) = [self.split_heads(self.project(x, i, 1), 1)
+                                              for i, x in enumerate((query, key, value))]
+            if cache is not None:
+                if 'k' in cache:
+                    key = torch.cat([cache['k'], key], dim = -2)
+                    value = torch.cat([cache['v'], value], dim = -2)
+                cache['k'], cache['v'] = key, value
         
         # 2) Apply attention on all the projected vectors in batch. 
         x, self.attn = attention(query, key, value, mask = mask, dropout = self.dropout)
         
-        # 3) "Concat" using a view and apply a final linear. 
-        x = x.transpose(1, 2).contiguous().view(nbatches, -1, self.h * self.d_k)
-        return self.linears[-1](x)
+        # 3) "Concat" using a view and apply a final linear. The fused SDPA kernels
+        # already lay their output out as [B, T, h, d_k], so this reshape is a free view.
+        x = x.transpose(1, 2).reshape(nbatches, -1, self.h * self.d_k)
+        return self.out(x)
 
 
 class PositionwiseFeedForward(nn.Module):
@@ -200,17 +282,6 @@ class PositionwiseFeedForward(nn.Module):
         return self.w_2(self.dropout(F.relu(self.w_1(x))))
 
 
-class Embeddings(nn.Module):
-    def __init__(self, d_model, vocab):
-        super(Embeddings, self).__init__()
-        self.lut = nn.Embedding(vocab, d_model)
-        self.d_model = d_model
-
-    def forward(self, x):
-        emb = self.lut(x) * math.sqrt(self.d_model)
-        return emb
-
-
 class PositionalEncoding(nn.Module):
     def __init__(self, d_model, dropout, max_len = 5000):
         super(PositionalEncoding, self).__init__()
@@ -225,27 +296,50 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0)
         self.register_buffer('pe', pe)
         
-    def forward(self, x):
-        x = x + Variable(self.pe[:, :x.size(1)], requires_grad =False)
+    def forward(self, x, offset = 0):
+        # `pe` is a buffer, so it never requires grad and follows model.half()/.to(dtype).
+        x = x + self.pe[:, offset:offset + x.size(1)].to(x.dtype)
         return self.dropout(x)
 
+
+class EmbedAndPE(PositionalEncoding):
+    # Embedding lookup, positional encoding and dropout in one module.
+    # The sqrt(d_model) scale is baked into `lut.weight` by make_model.
+    def __init__(self, d_model, vocab, dropout, max_len = 5000):
+        super(EmbedAndPE, self).__init__(d_model, dropout, max_len)
+        self.lut = nn.Embedding(vocab, d_model)
+        self.d_model = d_model
+
+    def forward(self, x, offset = 0):
+        return super(EmbedAndPE, self).forward(self.lut(x), offset)
+
 def make_model(src_vocab, tgt_vocab, N = 1, d_model = 512, d_ff = 2048, h = 1, dropout =0.1):
     "Helper: Construct a model from hyperparameters."
-    c = copy.deepcopy
-    attn = MultiHeadedAttention(h, d_model)
-    ff = PositionwiseFeedForward(d_model, d_ff, dropout)
-    position = PositionalEncoding(d_model, dropout)
+    attn = lambda: MultiHeadedAttention(h, d_model)
+    ff = lambda: PositionwiseFeedForward(d_model, d_ff, dropout)
     
     model = EncoderDecoder(
-        Encoder(EncoderLayer(d_model, c(attn), c(ff), dropout), N),
-        Decoder(DecoderLayer(d_model, c(attn), c(attn), c(ff), dropout), N),
-        nn.Sequential(Embeddings(d_model, src_vocab), c(position)),
-        nn.Sequential(Embeddings(d_model, tgt_vocab), c(position)),
+        Encoder(lambda: EncoderLayer(d_model, attn(), ff(), dropout), N),
+        Decoder(lambda: DecoderLayer(d_model, attn(), attn(), ff(), dropout), N),
+        EmbedAndPE(d_model, src_vocab, dropout),
+        EmbedAndPE(d_model, tgt_vocab, dropout),
         Generator(d_model, tgt_vocab))
     
     for p in model.parameters():
         if p.dim() > 1:
             nn.init.xavier_uniform_(p)
+
+    # Initialize Q, K and V separately so the fused weight starts like three d_model x d_model linears.
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, MultiHeadedAttention):
+                for w in m.qkv.weight.chunk(3):
+                    nn.init.xavier_uniform_(w)
+
+    # Fold the embedding scale into the weights once instead of multiplying every forward.
+    with torch.no_grad():
+        for embed in (model.src_embed, model.tgt_embed):
+            embed.lut.weight.mul_(math.sqrt(d_model))
             
     return model
 
@@ -254,19 +348,20 @@ class Batch:
     "Object for holding a batch of data with mask during training."
     def __init__(self, src, trg =None, pad =0):
         self.src = src
-        self.src_mask = (src != pad).unsqueeze(-2)
+        # Additive masks are built once per batch instead of `== 0` + masked_fill in every layer.
+        self.src_mask = additive_mask((src != pad).unsqueeze(-2))
         if trg is not None:
             self.trg = trg[:, :-1]
             self.trg_y = trg[:, 1:]
             self.trg_mask = self.make_std_mask(self.trg, pad)
-            self.ntokens = (self.trg_y != pad).data.sum()
+            self.ntokens = (self.trg_y != pad).sum()
 
     @staticmethod
     def make_std_mask(tgt, pad):
         "Create a mask to hide padding and future words."
         tgt_mask = (tgt != pad).unsqueeze(-2)
-        tgt_mask = tgt_mask & Variable(subsequent_mask(tgt.size(-1)).type_as(tgt_mask.data))
-        return tgt_mask
+        tgt_mask = tgt_mask & subsequent_mask(tgt.size(-1), tgt.device)
+        return additive_mask(tgt_mask)
 
 class NoamOpt:
     "Optim wrapper that implements rate."
@@ -294,27 +389,25 @@ class NoamOpt:
         return self.factor * (self.model_size ** (-0.5) * min(step ** (-0.5), step * self.warmup ** (-1.5)))
 
 class LabelSmoothing(nn.Module):
-    "Implement label smoothing."
+    "Label-smoothed cross-entropy on logits, summed over the non-padding targets."
     def __init__(self, size, padding_idx, smoothing =0.0):
         super(LabelSmoothing, self).__init__()
-        self.criterion = nn.KLDivLoss(size_average =False)
+        self.size = size
         self.padding_idx = padding_idx
-        self.confidence = 1.0 - smoothing
         self.smoothing = smoothing
-        self.size = size
-        self.true_dist = None
-        
+        try:
+            self.criterion = nn.CrossEntropyLoss(ignore_index = padding_idx, label_smoothing = smoothing, reduction = 'sum')
+        except TypeError:
+            # label_smoothing needs PyTorch >= 1.10; the loss is computed by hand below
+            self.criterion = None
+
     def forward(self, x, target):
-        assert x.size(1) == self.size
-        true_dist = x.data.clone()
-        true_dist.fill_(self.smoothing / (self.size - 2))
-        true_dist.scatter_(1, target.data.unsqueeze(1), self.confidence)
-        true_dist[:, self.padding_idx] = 0
-        mask = torch.nonzero(target.data == self.padding_idx)
-        if mask.dim() > 0:
-            true_dist.index_fill_(0, mask.squeeze(), 0.0)
-        self.true_dist = true_dist
-        return self.criterion(x, Variable(true_dist, requires_grad =False))
+        if self.criterion is not None:
+            return self.criterion(x, target)
+        logp = F.log_softmax(x.float(), dim = -1)
+        nll = -logp.gather(-1, target.unsqueeze(-1)).squeeze(-1)
+        loss = (1 - self.smoothing) * nll - self.smoothing * logp.mean(-1)
+        return loss.masked_fill(target == self.padding_idx, 0).sum()
 
 
 class SimpleLossCompute:
@@ -325,70 +418,16 @@ class SimpleLossCompute:
         self.opt = opt
         
     def __call__(self, x, y, norm):
-        x = self.generator(x)
-        loss = self.criterion(x.contiguous().view(-1, x.size(-1)), y.contiguous().view(-1)) / norm
+        with autocast():
+            x = self.generator.logits(x)
+            loss = self.criterion(x.contiguous().view(-1, x.size(-1)), y.contiguous().view(-1)) / norm
         loss.backward()
         if self.opt is not None:
             self.opt.step()
             self.opt.optimizer.zero_grad()
-        return loss.item() * norm
-
+        # Stay on the device; run_epoch only syncs when it logs.
+        return loss.detach() * norm
 
-class MultiGPULossCompute:
-    "A multi-gpu loss compute and train function."
-    def __init__(self, generator, criterion, devices, opt =None, chunk_size = 5):
-        # Send out to different gpus.
-        self.generator = generator
-        self.criterion = nn.parallel.replicate(criterion, devices = devices)
-        self.opt = opt
-        self.devices = devices
-        self.chunk_size = chunk_size
-        
-    def __call__(self, out, targets, normalize):
-        total = 0.0
-        
-        generator = nn.parallel.replicate(self.generator, devices = self.devices)
-        out_scatter = nn.parallel.scatter(out, target_gpus = self.devices)
-        out_grad = [[] for _ in out_scatter]
-        targets = nn.parallel.scatter(targets, target_gpus = self.devices)
-
-        # Divide generating into chunks.
-        chunk_size = self.chunk_size
-        for i in range(0, out_scatter[0].size(1), chunk_size):
-            # Predict distributions
-            out_column = [[Variable(o[:, i:i+chunk_size].data, 
-                                    requires_grad = self.opt is not None)] 
-                           for o in out_scatter]
-            gen = nn.parallel.parallel_apply(generator, out_column)
-
-            # Compute loss. 
-            y = [(g.contiguous().view(-1, g.size(-1)), 
-                  t[:, i:i+chunk_size].contiguous().view(-1)) 
-                 for g, t in zip(gen, targets)]
-            loss = nn.parallel.parallel_apply(self.criterion, y)
-
-            # Sum and normalize loss
-            l = nn.parallel.gather(loss, target_device = self.devices[0])
-            # l = l.sum()[0] / normalize
-            l = l.sum() / normalize
-            total += l.data
-            # total += l.data
-
-            # Backprop loss to output of transformer
-            if self.opt is not None:
-                l.backward()
-                for j, l in enumerate(loss):
-                    out_grad[j].append(out_column[j][0].grad.data.clone())
-
-        # Backprop all loss through transformer.
-        if self.opt is not None:
-            out_grad = [Variable(torch.cat(og, dim = 1)) for og in out_grad]
-            o1 = out
-            o2 = nn.parallel.gather(out_grad, target_device = self.devices[0])
-            o1.backward(gradient = o2)
-            self.opt.step()
-            self.opt.optimizer.zero_grad()
-        return total * normalize
 
 def run_epoch(data_iter, model, loss_compute):
     "Standard Training and Logging Function"
@@ -398,34 +437,41 @@ def run_epoch(data_iter, model, loss_compute):
     tokens = 0
 
     for i, batch in enumerate(data_iter):
-        out = model.forward(batch.src, batch.trg, batch.src_mask, batch.trg_mask)
+        with autocast():
+            out = model(batch.src, batch.trg, batch.src_mask, batch.trg_mask)
         loss = loss_compute(out, batch.trg_y, batch.ntokens)
-        total_loss += loss
-        total_tokens += batch.ntokens
-        tokens += batch.ntokens
+        total_loss = total_loss + loss
+        total_tokens = total_tokens + batch.ntokens
+        tokens = tokens + batch.ntokens
         if i % 50 == 1:
             elapsed = time.time() - start_time
-            print("Epoch Step: %d Loss: %f Tokens per Sec: %f" % (i, loss / batch.ntokens, tokens / elapsed))
-            logging.info(f'|Epoch Step: {i} Loss:{loss / batch.ntokens} Tokens per Sec: : {tokens / elapsed}')
+            step_loss = (loss / batch.ntokens).item()
+            rate = tokens.item() / elapsed
+            print("Epoch Step: %d Loss: %f Tokens per Sec: %f" % (i, step_loss, rate))
+            logging.info(f'|Epoch Step: {i} Loss:{step_loss} Tokens per Sec: : {rate}')
             
             start_time = time.time()
             tokens = 0
-    return total_loss / total_tokens
+    return (total_loss / total_tokens).item()
 
+@inference_mode()
 def predict(model, src, src_mask, tgt, max_len, start_symbol, g = 10):
     "Standard Sequence Inference Function"
 
     src = src.to(device)
     src_mask = src_mask.to(device)
+    labels = tgt[0].to(device)
     memory = model.encode(src, src_mask)
     ys = torch.ones(1, 1).fill_(start_symbol).type_as(src.data)
+    cache = model.decoder.init_cache()
 
     for i in range(max_len-1):
-        out = model.decode(memory, src_mask, Variable(ys), Variable(subsequent_mask(ys.size(1)).type_as(src.data)))
+        out = model.step_decode(memory, src_mask, ys[:, -1:], cache, i)
         prob = model.generator(out[:, -1])
        
-        predicted = torch.argsort(prob, 1)[0][-g:]
-        label = tgt[0][i].to(device)
+        # Only the top-g candidates are needed, not a full sort of the vocabulary.
+        predicted = torch.topk(prob, g, dim = 1)[1][0]
+        label = labels[i]
 
         if label not in predicted:
             abn = torch.tensor([-1])
@@ -438,27 +484,25 @@ def predict(model, src, src_mask, tgt, max_len, start_symbol, g = 10):
 
     return ys[:,1:]
 
+@inference_mode()
 def greedy_decode(model, src, src_mask, tgt, max_len, start_symbol, pred, g, halt, layers, heads):
+    labels = tgt[0]
     memory = model.encode(src, src_mask)
     ys = torch.ones(1, 1).fill_(start_symbol).type_as(src.data)
+    cache = model.decoder.init_cache()
     
     torch.set_printoptions(precision=2)
     
     for i in range(max_len-1):
-        out = model.decode(memory, src_mask, Variable(ys), Variable(subsequent_mask(ys.size(1)).type_as(src.data)))
+        out = model.step_decode(memory, src_mask, ys[:, -1:], cache, i)
         prob = model.generator(out[:, -1])
        
-        predicted = torch.argsort(prob, 1)[0][-g:]
-        label = tgt[0][i]   
+        predicted = torch.topk(prob, g, dim = 1)[1][0]
+        label = labels[i]
              
         if label == 0:
             return ys
         
-        _, next_key = torch.max(prob, dim = 1)
-        next_key = next_key.data[0]
-        torch.set_printoptions(precision=2)
-        
-        
         if pred:
             print("^^^^^^^^^^ ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^")
             print("Incoming log:", label) 
@@ -511,18 +555,22 @@ def greedy_decode(model, src, src_mask, tgt, max_len, start_symbol, pred, g, hal
                     
     return ys[:,1:]
 
-def data_gen(dataloader):
-    for seq, label in dataloader:
-        sos = torch.ones((seq.shape[0], 1),dtype = int).to(device)
-        eos = torch.ones((label.shape[0], 1),dtype = int).to(device)
-
-        t1 = torch.cat((sos, seq), 1)
-        t2 = torch.cat((eos, label), 1)
-        
-        src = Variable(t1, requires_grad =False)
-        tgt = Variable(t2, requires_grad =False)
+def data_gen(dataset, batch_size, shuffle =True, sampler =None):
+    "Yield shuffled Batches by slicing the prebuilt (start symbol + window) tensors."
+    src_all, tgt_all = dataset.tensors
+    n = src_all.size(0)
+    if sampler is not None:
+        # DistributedSampler hands each rank its own (equal sized) shard of indices.
+        order = torch.as_tensor(list(sampler), device = src_all.device)
+        n = order.size(0)
+    elif shuffle:
+        order = torch.randperm(n, device = src_all.device)
+    else:
+        order = torch.arange(n, device = src_all.device)
 
-        yield Batch(src, tgt, 0)
+    for j in range(0, n, batch_size):
+        idx = order[j:j + batch_size]
+        yield Batch(src_all[idx], tgt_all[idx], 0)
 
 def train_generate(name, data_dir, window_size = 10):
     num_sessions = 0
@@ -546,10 +594,22 @@ def train_generate(name, data_dir, window_size = 10):
 
     print("Sessions", len(inputs))
 
-    dataset = TensorDataset(torch.tensor(inputs, dtype = torch.int).to(device), torch.tensor(outputs).to(device))
+    # Prepend the start symbol (1) to every window in one vectorized build.
+    src = np.ones((len(inputs), window_size + 1), dtype = np.int64)
+    tgt = np.ones((len(outputs), window_size + 1), dtype = np.int64)
+    src[:, 1:] = np.asarray(inputs, dtype = np.int64).reshape(-1, window_size)
+    tgt[:, 1:] = np.asarray(outputs, dtype = np.int64).reshape(-1, window_size)
+
+    dataset = TensorDataset(to_device(torch.from_numpy(src)), to_device(torch.from_numpy(tgt)))
 
     return dataset
 
+def to_device(t):
+    "Upload a host tensor through pinned memory so the copy runs on the copy engine, asynchronously."
+    if device.type == 'cuda':
+        return t.pin_memory().to(device, non_blocking = True)
+    return t.to(device)
+
 def train(args):
     window_size = args.window_size
     batch = args.batch_size
@@ -561,51 +621,56 @@ def train(args):
     torch.manual_seed(args.seed)
 
     if use_cuda:
+        local_rank, world_size = setup_distributed()
         torch.cuda.manual_seed(args.seed)
-        if args.num_gpus == 1:
-            devices = [0]
-        elif args.num_gpus == 2:
-            devices = [0, 1]
 
     #Build model
     model = make_model(args.num_classes, args.num_classes, N = args.num_layers, h = args.num_heads, dropout = args.dropout)
     criterion = LabelSmoothing(size = args.num_classes, padding_idx =0, smoothing =0.1)
-    model_opt = NoamOpt(model.src_embed[0].d_model, 1, 2000, 
+    model_opt = NoamOpt(model.src_embed.d_model, 1, 2000, 
                         torch.optim.Adam(model.parameters(), lr =0, betas =(0.9, 0.98), eps = 1e-9))
     #Build dataset
     seq_dataset = train_generate(args.log_file, args.data_dir, window_size)
-    dataloader = DataLoader(seq_dataset, batch, shuffle =True)
     
     start_time = time.time()
     if use_cuda:
         model.cuda()
         criterion.cuda()
-        model_par = nn.DataParallel(model, device_ids = devices)
+        model_par = distribute(model, local_rank)
+        if getattr(args, 'compile', False):
+            model_par = compile_model(model_par)
+        sampler = DistributedSampler(seq_dataset, seed = args.seed) if world_size > 1 else None
 
         for epoch in tqdm(range(epochs)):
             model_par.train()
-            run_epoch(data_gen(dataloader), model_par, 
-                                MultiGPULossCompute(model.generator, criterion, devices = devices, opt = model_opt))
+            if sampler is not None:
+                sampler.set_epoch(epoch)
+            run_epoch(data_gen(seq_dataset, batch, sampler = sampler), model_par, 
+                                SimpleLossCompute(model.generator, criterion, model_opt))
             
             # model_par.eval()
-            # loss = run_epoch(data_gen(dataloader), model_par, 
-            #                           MultiGPULossCompute(model.generator, criterion, devices = devices, opt =None))            
+            # loss = run_epoch(data_gen(seq_dataset, batch), model_par, 
+            #                           SimpleLossCompute(model.generator, criterion, None))            
 #             print(loss)
             
             epoch_mins, epoch_secs = epoch_time(start_time, time.time())
             logging.info(f'Training Time: {epoch_mins}m {epoch_secs}s')    
 
-            if not os.path.exists(args.model_dir):
-                os.mkdir(args.model_dir)
+            if is_main_process():
+                if not os.path.exists(args.model_dir):
+                    os.mkdir(args.model_dir)
 
-            torch.save(model, os.path.join(args.model_dir, "centralized_model.pt"))
+                torch.save(model, os.path.join(args.model_dir, "centralized_model.pt"))
     else:
         model.train()
-        run_epoch(data_gen(dataloader), model, SimpleLossCompute(model.generator, criterion, model_opt))
+        run_epoch(data_gen(seq_dataset, batch), compile_model(model) if getattr(args, 'compile', False) else model, 
+                  SimpleLossCompute(model.generator, criterion, model_opt))
         # model.eval()
         # print(run_epoch(data_gen(log_file, window_size, batch), model, SimpleLossCompute(model.generator, criterion, None)))
     
-    test(args)
+    if is_main_process():
+        test(args)
+    cleanup_distributed()
     
     return model
 
@@ -622,13 +687,12 @@ def federated_training(args):
     logging.basicConfig(filename="results.log", level=logging.DEBUG)
     
     torch.manual_seed(args.seed)
+    # Every rank must sample the same clients each round.
+    np.random.seed(args.seed)
 
     if use_cuda:
+        local_rank, world_size = setup_distributed()
         torch.cuda.manual_seed(args.seed)
-        if args.num_gpus == 1:
-            devices = [0]
-        elif args.num_gpus == 2:
-            devices = [0, 1]
 
     global_model = make_model(args.num_classes, args.num_classes, N = args.num_layers, h = args.num_heads)
     criterion = LabelSmoothing(size = args.num_classes, padding_idx =0, smoothing =0.1)
@@ -638,13 +702,12 @@ def federated_training(args):
     clients_dir = "clients_" + str(clients)
     data_dir = os.path.join(args.data_dir, clients_dir)
 
-    if not os.path.exists(args.model_dir):
+    if is_main_process() and not os.path.exists(args.model_dir):
         os.mkdir(args.model_dir)
 
     if use_cuda:
         global_model.cuda()
         criterion.cuda()
-        model_par = nn.DataParallel(global_model, device_ids = devices)
 
         global_model.train()
         global_weights = global_model.state_dict()
@@ -661,21 +724,25 @@ def federated_training(args):
                 client_file = args.log_file + "_" + str(i)
                 
                 seq_dataset = train_generate(client_file, data_dir, window_size)
-                dataloader = DataLoader(seq_dataset, batch, shuffle =True)
 
                 model = copy.deepcopy(global_model)
-                model_opt = NoamOpt(model.src_embed[0].d_model, 1, 2000, 
+                model_opt = NoamOpt(model.src_embed.d_model, 1, 2000, 
                                     torch.optim.Adam(model.parameters(), lr =0, betas =(0.9, 0.98), eps = 1e-9))
                 model.cuda()
-                model_par = nn.DataParallel(model, device_ids = devices)
+                model_par = distribute(model, local_rank)
+                if getattr(args, 'compile', False):
+                    model_par = compile_model(model_par)
+                sampler = DistributedSampler(seq_dataset, seed = args.seed) if world_size > 1 else None
 
                 for epoch in range(epochs):
                     model_par.train()
-                    loss = run_epoch(data_gen(dataloader), model_par, 
-                                        MultiGPULossCompute(model.generator, criterion, devices = devices, opt = model_opt))
+                    if sampler is not None:
+                        sampler.set_epoch(epoch)
+                    loss = run_epoch(data_gen(seq_dataset, batch, sampler = sampler), model_par, 
+                                        SimpleLossCompute(model.generator, criterion, model_opt))
                     # model_par.eval()
-                    # loss = run_epoch(data_gen(dataloader), model_par, 
-                    #                   MultiGPULossCompute(model.generator, criterion, devices = devices, opt =None))   
+                    # loss = run_epoch(data_gen(seq_dataset, batch), model_par, 
+                    #                   SimpleLossCompute(model.generator, criterion, None))   
                     logging.info(f'\n | Loss : {loss} |\n')
                     
 
@@ -684,10 +751,11 @@ def federated_training(args):
             global_weights = average_weights(local_weights)
             global_model.load_state_dict(global_weights)
             
-            torch.save(global_model, os.path.join(args.model_dir, "global_model.pt"))
+            if is_main_process():
+                torch.save(global_model, os.path.join(args.model_dir, "global_model.pt"))
             
-            if (roundd + 1) % 2 == 0:
-                test(args)
+                if (roundd + 1) % 2 == 0:
+                    test(args)
     else:
         for roundd in tqdm(range(rounds)):
             local_weights, local_losses = [], []
@@ -700,15 +768,16 @@ def federated_training(args):
             for i in idxs_users:
                 client_file = args.log_file + "_" + str(i)
                 seq_dataset = train_generate(client_file, args.data_dir, window_size)
-                dataloader = DataLoader(seq_dataset, batch, shuffle =True)
 
                 model = copy.deepcopy(global_model)
-                model_opt = NoamOpt(model.src_embed[0].d_model, 1, 2000, 
+                model_opt = NoamOpt(model.src_embed.d_model, 1, 2000, 
                                     torch.optim.Adam(model.parameters(), lr =0, betas =(0.9, 0.98), eps = 1e-9))
 
+                model_run = compile_model(model) if getattr(args, 'compile', False) else model
+
                 for epoch in range(epochs):
                     model.train()
-                    run_epoch(data_gen(client_file, window_size, batch), model, SimpleLossCompute(model.generator, criterion, model_opt))
+                    run_epoch(data_gen(seq_dataset, batch), model_run, SimpleLossCompute(model.generator, criterion, model_opt))
                     # model.eval()
                     # print(run_epoch(data_gen(log_file, window_size, batch), model, SimpleLossCompute(model.generator, criterion, None)))
 
@@ -724,16 +793,44 @@ def federated_training(args):
 
     epoch_mins, epoch_secs = epoch_time(start_time, time.time())
     logging.info(f'Federated Training Time: {epoch_mins}m {epoch_secs}s')
+    cleanup_distributed()
     
     return global_model
 
+def setup_distributed():
+    "Join the process group when launched with torchrun; returns (local_rank, world_size)."
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    torch.cuda.set_device(local_rank)
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend = 'nccl')
+    return local_rank, world_size
+
+def cleanup_distributed():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+def is_main_process():
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+def distribute(model, local_rank):
+    "Wrap the model with DDP when running under a process group, otherwise use it as-is."
+    if dist.is_available() and dist.is_initialized():
+        return DDP(model, device_ids = [local_rank])
+    return model
+
+def compile_model(model):
+    "JIT-compile the model's forward with TorchInductor (PyTorch >= 2.0); returns it unchanged otherwise."
+    if not hasattr(torch, 'compile'):
+        logging.warning('torch.compile is not available in PyTorch %s, running eagerly', torch.__version__)
+        return model
+    return torch.compile(model)
+
 def average_weights(w):
-    w_avg = copy.deepcopy(w[0])
-    for key in w_avg.keys():
-        for i in range(1, len(w)):
-            w_avg[key] += w[i][key]
-        w_avg[key] = torch.div(w_avg[key], len(w))
-    return w_avg
+    "FedAvg: element-wise mean of the clients' state dicts, one fused reduction per key."
+    target = next(iter(w[0].values())).device
+    return {key: torch.stack([sd[key].to(target).float() for sd in w]).mean(0).to(w[0][key].dtype)
+            for key in w[0].keys()}
 
 def test(args):
 
@@ -758,7 +855,7 @@ def test(args):
     test_normal_loader = test_generate(os.path.join(args.data_dir, args.log_normal))
     test_abnormal_loader = test_generate(os.path.join(args.data_dir, args.log_abnormal))               
 
-    src_mask = Variable(torch.ones(1, 1, window_size + 1)).to(device)
+    src_mask = torch.ones(1, 1, window_size + 1, dtype = torch.bool).to(device)
     bos = torch.ones((1, ),dtype = int).to(device)
 
     num = 200
@@ -766,18 +863,17 @@ def test(args):
     start_time = time.time()
     num_session = 0
 
-    with torch.no_grad():
+    with inference_mode(), autocast():
         for line in test_normal_loader:
             num_session += 1
+            # One host-to-device copy per session; windows are sliced on the device.
+            line = torch.tensor(line, dtype = torch.long).to(device)
             for i in range(len(line) - window_size):
                 seq = line[i:i + window_size]
                 label = line[i+window_size:(i+window_size)+window_size]
 
-                t1 = torch.cat((bos, torch.tensor(seq, dtype = torch.int).to(device))).unsqueeze(0)
-                t2 = torch.tensor(label, dtype = torch.int).to(device).unsqueeze(0)
-                
-                src = Variable(t1, requires_grad =False)                
-                tgt = Variable(t2, requires_grad =False)
+                src = torch.cat((bos, seq)).unsqueeze(0)
+                tgt = label.unsqueeze(0)
 
                 pred = predict(model, src, src_mask, tgt, max_len = len(tgt)+1, start_symbol = 1, g = args.num_candidates) 
 
@@ -802,18 +898,16 @@ def test(args):
     start_time = time.time()
     num_session = 0
 
-    with torch.no_grad():
+    with inference_mode(), autocast():
         for line in test_abnormal_loader:        
             num_session += 1
+            line = torch.tensor(line, dtype = torch.long).to(device)
             for i in range(len(line) - window_size):
                 seq = line[i:i + window_size]
                 label = line[i+window_size:(i+window_size)+window_size]
                 
-                t1 = torch.cat((bos, torch.tensor(seq, dtype = torch.int).to(device))).unsqueeze(0)
-                t2 = torch.tensor(label, dtype = torch.int).to(device).unsqueeze(0)
-                
-                src = Variable(t1, requires_grad =False)
-                tgt = Variable(t2, requires_grad =False)
+                src = torch.cat((bos, seq)).unsqueeze(0)
+                tgt = label.unsqueeze(0)
 
                 pred = predict(model, src, src_mask, tgt, max_len = len(tgt)+1, start_symbol = 1, g = args.num_candidates)
 
@@ -29,7 +29,8 @@ if __name__ == '__main__':
     parser.add_argument('--num_candidates', default=10, type=int, help='number of predictors sequence as correct predict')
 
     parser.add_argument('--federated', default=True, type=bool, help='number of gpus of gpus to train')    
-    parser.add_argument('--num_gpus', default=1, type=int, help='number of gpus of gpus to train')
+    parser.add_argument('--num_gpus', default=1, type=int, help='train on gpu when > 0; launch with torchrun --nproc_per_node=N for multi-gpu')
+    parser.add_argument('--compile', action='store_true', help='compile the model with torch.compile before training')
     parser.add_argument('--model_dir', default='Model', type=str, help='the directory to store the model')
     parser.add_argument('--data_dir', default='Dataset/Linux', type=str, help='the directory where training data is stored')
 
@@ -7,12 +7,54 @@ import numpy as np
 import importlib
 import re
 import pickle
+import shutil
+import hashlib
+import logging
+import concurrent.futures
 from Parsers import Spell
 
-importlib.reload(Spell)
+# Re-executing the parser module is only useful while editing it from a notebook
+if os.environ.get("PREPROCESS_DEV_RELOAD"):
+    importlib.reload(Spell)
 
+# HDFS block ids come in two formats: blk_123 and blk_-123
+_BLK_PATTERN = r'(blk_-?\d+)'
 
-def parse(log_source, log_file, algorithm):
+# Side outputs Spell writes into its output directory on every parse
+_SPELL_OUTPUTS = ('out_structured.csv', 'out_templates.csv')
+
+# Number of distinct parses kept in each output directory's cache, least recently used go first
+_PARSE_CACHE_ENTRIES = 4
+
+# Write buffer for the sequence files (1 MiB instead of the 8 KiB default)
+_WRITE_BUFFER = 1 << 20
+
+# Masking regexes per log source
+_REGEX_PATTERNS = {
+    'HDFS': [
+        r'blk_(|-)[0-9]+' , # block id
+        r'(/|)([0-9]+\.){3}[0-9]+(:[0-9]+|)(:|)', # IP
+        r'(?<=[^A-Za-z0-9])(\-?\+?\d+)(?=[^A-Za-z0-9])|[0-9]+$', # Numbers
+    ],
+    'Linux': [r'(\d+\.){3}\d+', r'\d{2}:\d{2}:\d{2}',
+        r'\w{8}\-\w{4}\-\w{4}\-\w{4}\-\w{12}' # Kernel
+        r'(/|)([0-9]+\.){3}[0-9]+(:[0-9]+|)(:|)', # IP
+        r'(?<=[^A-Za-z0-9])(\-?\+?\d+)(?=[^A-Za-z0-9])|[0-9]+$', # Numbers
+    ],
+    'Openstack': [
+        r'((\d+\.){3}\d+,?)+',
+        r'/.+?\s', r'\d+',
+#             's/\b[a-z0-9]\{8\}-[a-z0-9]\{4\}-[a-z0-9]\{4\}-[a-z0-9]\{4\}-[a-z0-9]\{12\}\b/MASKED_ID/g'
+        r'\w{8}\-\w{4}\-\w{4}\-\w{4}\-\w{12}'
+        r'(/|)([0-9]+\.){3}[0-9]+(:[0-9]+|)(:|)', # IP
+        r'(?<=[^A-Za-z0-9])(\-?\+?\d+)(?=[^A-Za-z0-9])|[0-9]+$', # Numbers
+    ],
+}
+# Compiled once at import so repeated parse() calls reuse them
+_REGEX_CACHE = {source: [re.compile(p) for p in patterns] for source, patterns in _REGEX_PATTERNS.items()}
+
+
+def parse(log_source, log_file, algorithm, output_dir=None):
     """
     Parses log file.
 
@@ -20,10 +62,12 @@ def parse(log_source, log_file, algorithm):
         log_source: The source of the logs (e.g. HDFS, Openstack, Linux).
         log_file: The name of the log file.
         algorithm: Parsing algorithm: Spell or Drain.
+        output_dir: Directory for the parser outputs, defaults to <algorithm>_results/.
     """
     
     input_dir = 'Dataset/' + log_source + "/"
-    output_dir = algorithm + "_results/"
+    if output_dir is None:
+        output_dir = algorithm + "_results/"
     
     st = 0.5
     
@@ -32,44 +76,52 @@ def parse(log_source, log_file, algorithm):
     if log_source == 'HDFS':
         log_format = '<Date> <Time> <Pid> <Level> <Component>: <Content>'
 #         regex = [r'blk_-?\d+', r'(\d+\.){3}\d+(:\d+)?']
-        regex      = [
-            r'blk_(|-)[0-9]+' , # block id
-            r'(/|)([0-9]+\.){3}[0-9]+(:[0-9]+|)(:|)', # IP
-            r'(?<=[^A-Za-z0-9])(\-?\+?\d+)(?=[^A-Za-z0-9])|[0-9]+$', # Numbers
-        ]
         tau = 0.66
     #Linux Logs
     elif log_source == 'Linux':
         log_format = '<Month> <Date> <Time> <Level> <Component>(\[<PID>\])?: <Content>'
 #         regex = [r'(\d+\.){3}\d+', r'\d{2}:\d{2}:\d{2}']
-        regex      = [r'(\d+\.){3}\d+', r'\d{2}:\d{2}:\d{2}',
-            r'\w{8}\-\w{4}\-\w{4}\-\w{4}\-\w{12}' # Kernel
-            r'(/|)([0-9]+\.){3}[0-9]+(:[0-9]+|)(:|)', # IP
-            r'(?<=[^A-Za-z0-9])(\-?\+?\d+)(?=[^A-Za-z0-9])|[0-9]+$', # Numbers
-        ]   
         tau = 0.50
     #Openstack Logs
     elif log_source == 'Openstack':
 #         log_format = '<Logrecord> <Date> <Time> <Pid> <Level> <Component> \[<ADDR>\] \[<Instance>\] <Content>'
         log_format = '<Logrecord> <Date> <Time> <Pid> <Level> <Component> \[<ADDR>\] <Content>'
 #         regex = [r'((\d+\.){3}\d+,?)+', r'/.+?\s', r'\d+', r'\w{8}-\w{4}-\w{4}-\w{4}-\w{12}']
-        regex      = [
-            r'((\d+\.){3}\d+,?)+', 
-            r'/.+?\s', r'\d+', 
-#             's/\b[a-z0-9]\{8\}-[a-z0-9]\{4\}-[a-z0-9]\{4\}-[a-z0-9]\{4\}-[a-z0-9]\{12\}\b/MASKED_ID/g'
-            r'\w{8}\-\w{4}\-\w{4}\-\w{4}\-\w{12}'
-            r'(/|)([0-9]+\.){3}[0-9]+(:[0-9]+|)(:|)', # IP
-            r'(?<=[^A-Za-z0-9])(\-?\+?\d+)(?=[^A-Za-z0-9])|[0-9]+$', # Numbers
-        ]  
         tau = 0.66
 
-    #Initialize parser
-    parser = Spell.LogParser(indir=input_dir, outdir=output_dir, log_format=log_format, tau=tau, rex=regex)
-    parsed_logs = parser.parse(log_file)
+    regex = _REGEX_CACHE[log_source]
+
+    # Reuse the parse from an earlier run when the input and parameters are unchanged. Spell's
+    # side outputs are cached with it, so the csvs in output_dir always match this parse. Only
+    # sources whose sequences are built from the returned frame keep a pickle of it.
+    cache_prefix = os.path.join(output_dir, '.cache_' + _parse_cache_key(input_dir, log_file, log_format, tau, regex))
+    cache_path = cache_prefix + '.pkl'
+    keep_frame = log_source == "Linux"
+    cached_outputs = [(os.path.join(output_dir, name), cache_prefix + '_' + name) for name in _SPELL_OUTPUTS]
+    cache_files = [cached for _, cached in cached_outputs] + ([cache_path] if keep_frame else [])
+    if all(os.path.exists(cached) for cached in cache_files):
+        for output, cached in cached_outputs:
+            _link_or_copy(cached, output)
+        for cached in cache_files:
+            os.utime(cached)
+        parsed_logs = pd.read_pickle(cache_path) if keep_frame else None
+    else:
+        # Spell rewrites its outputs in place, so drop any link into the cache first
+        for output, _ in cached_outputs:
+            if os.path.exists(output):
+                os.remove(output)
+        #Initialize parser
+        parser = Spell.LogParser(indir=input_dir, outdir=output_dir, log_format=log_format, tau=tau, rex=regex)
+        parsed_logs = parser.parse(log_file)
+        if keep_frame:
+            parsed_logs.to_pickle(cache_path)
+        for output, cached in cached_outputs:
+            _link_or_copy(output, cached)
+        _evict_parse_cache(output_dir)
     
 #     Convert parse into sequences
     if log_source == "Linux":
-        linux_seq(parsed_logs)
+        linux_seq(_compact_columns(parsed_logs))
 #     elif log_source == "HDFS":
 #         hdfs_seq(parsed_logs, input_dir, log_source)
 #     elif log_source == "Openstack":
@@ -77,6 +129,73 @@ def parse(log_source, log_file, algorithm):
 #         openstack_seq(output_dir, log_source)
     
     return
+
+def parse_many(sources):
+    """
+    Parses several log files in parallel, one process per file.
+
+    Each job writes its parser outputs to <algorithm>_results/<log_source>/, and its sequence
+    files to Dataset/<log_source>/, so every log source may appear only once.
+
+    Args:
+        sources: List of (log_source, log_file, algorithm) tuples, as passed to parse().
+    """
+    if not sources:
+        return
+    log_sources = [log_source for log_source, _, _ in sources]
+    duplicates = sorted({log_source for log_source in log_sources if log_sources.count(log_source) > 1})
+    if duplicates:
+        raise ValueError("parse_many writes one set of sequence files per log source, got duplicates: %s" % ", ".join(duplicates))
+    output_dirs = [algorithm + "_results/" + log_source + "/" for log_source, _, algorithm in sources]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(sources), os.cpu_count() or 1)) as ex:
+        # parse is a module level function, so it pickles across processes; list() surfaces worker errors
+        list(ex.map(parse, *zip(*sources), output_dirs))
+
+    return
+
+def _compact_columns(df_log):
+    # Arrow backed strings store Content contiguously instead of one Python object per line.
+    # Needs pyarrow and pandas >= 1.2, otherwise the column keeps the default object dtype.
+    try:
+        df_log['Content'] = df_log['Content'].astype('string[pyarrow]')
+    except (ImportError, TypeError):
+        pass
+    df_log['Log Key'] = df_log['Log Key'].astype('int32')
+    return df_log
+
+def _link_or_copy(src, dst):
+    # Hard links make restoring a cached multi-GB csv free; copy where links are unsupported
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def _evict_parse_cache(output_dir):
+    # Cache files are named .cache_<32 hex digit key>..., group them per key and keep the newest entries
+    entries = {}
+    for name in os.listdir(output_dir):
+        if name.startswith('.cache_'):
+            entries.setdefault(name[7:39], []).append(os.path.join(output_dir, name))
+    by_age = sorted(entries.values(), key=lambda paths: max(os.path.getmtime(p) for p in paths), reverse=True)
+    for paths in by_age[_PARSE_CACHE_ENTRIES:]:
+        for path in paths:
+            os.remove(path)
+
+def _parse_cache_key(input_dir, log_file, log_format, tau, regex):
+    # Hash of the raw log contents plus every setting that changes the parse
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((log_format, tau, [r.pattern for r in regex])).encode())
+    if isinstance(log_file, list):
+        # Spell takes a list as the log lines themselves, not as file names
+        h.update("\n".join(map(str, log_file)).encode())
+    else:
+        with open(os.path.join(input_dir, log_file), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
     
 def linux_seq(df_log):
     
@@ -105,11 +224,7 @@ def linux_time(df):
     return deeplog_df
 
 def linux_file_generator(log_source, filename, df):
-    with open("Dataset/" + log_source + "/" + log_source + "_" + filename, 'w') as f:
-        for event_id_list in df['Log Key']:
-            for event_id in event_id_list:
-                f.write(str(event_id) + ' ')
-            f.write('\n') 
+    _write_seqs("Dataset/" + log_source + "/" + log_source + "_" + filename, df['Log Key'])
 
 def openstack_seq_instance(df_log):
     normal = df_log[df_log["Date"] != "2017-05-14"]
@@ -132,40 +247,64 @@ def openstack_seq_instance(df_log):
     return
     
 def hdfs_seq(df_log, output_dir, log_source):
-    labels = pd.read_csv( "Dataset/" + log_source + "/anomaly_label.csv").groupby("Label")
-    normal_labels = labels.get_group("Normal")["BlockId"].values
-    anomaly_labels = labels.get_group("Anomaly")["BlockId"].values
-
+    normal_labels, anomaly_labels = _hdfs_labels(log_source)
     norm_seq = {}
     abn_seq = {}
+    _hdfs_accumulate(df_log, normal_labels, anomaly_labels, norm_seq, abn_seq)
+
+    hdfs_file_generator(output_dir, log_source, norm_seq, abn_seq)
     
-    #Iterate through all parsed logs to create sequences
-    for index, row in df_log.iterrows():
-        # Get raw log content
-        line= row['Content']
-
-        # Block ids are can be in two different formats
-        if re.search("blk_-\d*", line):
-            seq_id = re.findall("blk_-\d*", line)[0]
-        elif re.search("blk_\d*", line):
-            seq_id = re.findall("blk_\d*", line)[0]
-        else:
-            print("Missing Block ID")
+    return
 
-        if seq_id in normal_labels:
-            if seq_id in norm_seq:
-                norm_seq[seq_id].append(row['Log Key'])
-            else:
-                norm_seq[seq_id] = [row['Log Key']]
-        if seq_id in anomaly_labels:
-            if seq_id in abn_seq:
-                abn_seq[seq_id].append(row['Log Key'])
-            else:
-                abn_seq[seq_id] = [row['Log Key']]
+def hdfs_seq_csv(structured_csv, output_dir, log_source, chunksize=200000):
+    """
+    Builds HDFS sequences from the parser's structured csv without loading it whole.
+
+    Standalone entry point, parse() does not call it. Pass the out_structured.csv from the
+    output directory of the most recent parse() of these logs (Spell_results/out_structured.csv
+    by default); it is valid until the next parse() into that directory. Needs the labels in
+    Dataset/<log_source>/anomaly_label.csv.
+
+    Args:
+        structured_csv: Path of the structured csv written by the parser.
+        output_dir: Directory the sequence files are written to.
+        log_source: The source of the logs (e.g. HDFS).
+        chunksize: Number of parsed log lines held in memory at a time.
+    """
+    normal_labels, anomaly_labels = _hdfs_labels(log_source)
+    norm_seq = {}
+    abn_seq = {}
+    for chunk in pd.read_csv(structured_csv, usecols=['Content', 'Log Key'], chunksize=chunksize):
+        _hdfs_accumulate(_compact_columns(chunk), normal_labels, anomaly_labels, norm_seq, abn_seq)
 
     hdfs_file_generator(output_dir, log_source, norm_seq, abn_seq)
-    
+
     return
+
+def _hdfs_labels(log_source):
+    labels = pd.read_csv( "Dataset/" + log_source + "/anomaly_label.csv", usecols=['BlockId', 'Label'],
+                         dtype={'BlockId': 'string', 'Label': 'category'})
+    normal_labels = frozenset(labels.loc[labels['Label'] == 'Normal', 'BlockId'])
+    anomaly_labels = frozenset(labels.loc[labels['Label'] == 'Anomaly', 'BlockId'])
+    return normal_labels, anomaly_labels
+
+def _hdfs_accumulate(df_log, normal_labels, anomaly_labels, norm_seq, abn_seq):
+    # Extract every block id in one pass
+    blk_ids = df_log['Content'].str.extract(_BLK_PATTERN, expand=False)
+    missing = blk_ids.isna()
+    if missing.any():
+        logging.warning('Missing Block ID in %d logs, skipping them', missing.sum())
+
+    # Group log keys into one sequence per block, keeping the order blocks first appear in
+    grouped = df_log.assign(BlockId=blk_ids)[~missing].groupby('BlockId', sort=False)['Log Key'].apply(list).to_dict()
+
+    # Normal and Anomaly are disjoint, so a block matching one never needs the other lookup.
+    # Blocks seen in an earlier chunk are extended in place, so order is kept across chunks.
+    for seq_id, log_keys in grouped.items():
+        if seq_id in normal_labels:
+            norm_seq.setdefault(seq_id, []).extend(log_keys)
+        elif seq_id in anomaly_labels:
+            abn_seq.setdefault(seq_id, []).extend(log_keys)
             
 def openstack_seq(output_dir, log_source):
     df = pd.read_csv('Spell_results/openstack.log_structured.csv')
@@ -187,16 +326,8 @@ def openstack_seq(output_dir, log_source):
     return
 
 def hdfs_file_generator(input_dir, log_source, seqs, abn_seq = ''):
-    with open(input_dir + log_source + '_normal', 'w') as f:
-        for item in seqs:
-            for log_key in seqs[item]:
-                f.write(str(log_key)+" ")
-            f.write("\n")
-    with open(input_dir + log_source + '_abnormal', 'w') as f:
-        for item in abn_seq:
-            for log_key in abn_seq[item]:
-                f.write(str(log_key)+" ")
-            f.write("\n")
+    _write_seqs(input_dir + log_source + '_normal', (seqs[item] for item in seqs))
+    _write_seqs(input_dir + log_source + '_abnormal', (abn_seq[item] for item in abn_seq))
 
 def pkl_to_csv(pkl_file, log_source, machine):
     with open('../System Logs/' + pkl_file, 'rb') as f:
@@ -218,7 +349,7 @@ def federated_split(log_seq, log_source, clients):
     f_id = 1
     
     with open(input_dir + log_seq) as infile:
-        f = open(input_dir + log_seq + '_%d' %f_id, 'w')
+        f = open(input_dir + log_seq + '_%d' %f_id, 'w', buffering=_WRITE_BUFFER)
         
         for i, line in enumerate(infile):
             f.write(line)
@@ -227,19 +358,19 @@ def federated_split(log_seq, log_source, clients):
                 f.close()
                 f_id += 1
                 if f_id <= clients:
-                    f = open(input_dir + log_seq + '_%d' %f_id, 'w')
+                    f = open(input_dir + log_seq + '_%d' %f_id, 'w', buffering=_WRITE_BUFFER)
                 else:
                     break
         f.close()
         
 def backtrace(pred, log_source, algorithm):
     log_template = pd.read_csv(algorithm + "_results/" + log_source + ".log_templates.csv") 
-    y = np.squeeze(pred.tolist())
-    
-    for log in pred:
-        log = log.cpu().detach().numpy() 
-        if log == -1: continue
-        print(log, log_template.loc[log_template['Log Key']==log]['Message'])
+    y = np.asarray(pred.tolist()).ravel()
+    y = y[y != -1]
+
+    # Templates are sorted by occurrence, so look them up by key rather than by position
+    messages = log_template.set_index('Log Key')['Message'].reindex(y).to_numpy()
+    print("\n".join("%s %s" % (k, m) for k, m in zip(y, messages)))
         
 def deeplog_df_transfer(df):
     df['datetime'] = pd.to_datetime(df['Date'] + ' ' + df['Time'])
@@ -252,8 +383,12 @@ def _custom_resampler(array_like):
     return list(array_like)
 
 def openstack_file_generator(log_source, filename, df):
-    with open("Dataset/" + log_source + "/" + log_source + "_" + filename, 'w') as f:
-        for event_id_list in df['Log Key']:
-            for event_id in event_id_list:
-                f.write(str(event_id) + ' ')
-            f.write('\n')
\ No newline at end of file
+    _write_seqs("Dataset/" + log_source + "/" + log_source + "_" + filename, df['Log Key'])
+
+def _write_seqs(path, seqs):
+    # One space separated line per sequence, written in a single call
+    lines = [" ".join(map(str, seq)) for seq in seqs]
+    with open(path, 'w', buffering=_WRITE_BUFFER) as f:
+        if lines:
+            f.write("\n".join(lines))
+            f.write("\n")
\ No newline at end of file